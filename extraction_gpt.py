@@ -3,51 +3,309 @@ import sys
 import csv
 import json
 import base64
+import asyncio
+import hashlib
+import itertools
+import tempfile
+import mmap
+import time
+import functools
+from io import BytesIO
 from dotenv import load_dotenv
-from openai import OpenAI
+from PIL import Image
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_loads(data):
+        return json.loads(bytes(data))
 
 load_dotenv()
 
+# Directory containing this script; default input/output paths live here
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Maximum number of images sent to the API at the same time
+MAX_CONCURRENCY = 5
+
+MODEL = "gpt-5.2"
+
+PROMPT = (
+    "Extract ALL transactions from this bank statement image.\n\n"
+    "Step 1: Identify the column headers exactly as they appear in the table.\n"
+    "Step 2: Extract every transaction row using those exact column names as JSON keys.\n\n"
+    "Return a JSON object with two keys:\n"
+    '  "columns": an array of the column header names exactly as shown in the image\n'
+    '  "transactions": an array of objects, each using those column names as keys\n\n'
+    "Rules:\n"
+    "- Preserve dates exactly as shown (e.g. '15 MAY', '03/02', 'Mar 15')\n"
+    "- Preserve numbers exactly as shown, including commas and any suffixes like 'DR' or 'CR'\n"
+    "- If there is a B/F Balance or Previous Balance row, include it as a transaction\n"
+    "- Do NOT include summary rows like 'Ending balance' or 'Balance Carried Forward'\n"
+    "- For multi-line descriptions, combine them into a single string separated by spaces\n"
+    "- If a cell is empty, use an empty string\n"
+    "- Return ONLY the JSON object, no markdown or explanation"
+)
+
+# The prompt part of the message never changes, so it is built once and
+# shared by every request; only the image part is created per call.
+PROMPT_PART = {"type": "text", "text": PROMPT}
+
+# Parsed API responses are cached here, keyed by image + model + prompt,
+# so repeated runs on the same image cost no tokens.
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "extraction_gpt")
+CACHE_MODES = ("read_write", "read_only", "off")
+
+# Larger scans are downscaled to this many px on the long edge before
+# upload to cut payload size and image-input tokens. Override with the
+# MAX_IMAGE_SIDE environment variable; 0 sends images at full size.
+MAX_IMAGE_SIDE = int(os.getenv("MAX_IMAGE_SIDE", "1024"))
+JPEG_QUALITY = 85
+
+# Upper bound on requests per second across all concurrent images
+REQUESTS_PER_SECOND = 5
+
+
+class AsyncLimiter:
+    """
+    Token-bucket rate limiter. Each `async with limiter:` consumes one
+    token; tokens refill at `rps` per second up to a burst of `rps`.
+    """
+
+    def __init__(self, rps):
+        self.rps = rps
+        self._tokens = rps
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rps, self._tokens + (now - self._last) * self.rps)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return self
+                await asyncio.sleep((1 - self._tokens) / self.rps)
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+limiter = AsyncLimiter(REQUESTS_PER_SECOND)
+
+
+def _is_retryable(e):
+    """
+    Transient failures worth retrying: rate limits (429 / quota),
+    server errors (5xx) and dropped connections or timeouts.
+    Anything else (bad request, auth, ...) is raised immediately.
+    """
+    if isinstance(e, APIConnectionError):
+        return True
+    if isinstance(e, APIStatusError):
+        if e.status_code == 429 or e.status_code >= 500:
+            return True
+    msg = str(e).lower()
+    return "rate limit" in msg or "quota" in msg
+
+
+def retry_with_backoff(max_attempts=3, min_wait=1, max_wait=30):
+    """
+    Decorator for coroutines: retry transient API errors with
+    exponential backoff (min_wait * 2**attempt, capped at max_wait).
+    The wrapped coroutine accepts an extra `label` keyword (not passed
+    on) that tags retry messages, e.g. with the image name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, label=None, **kwargs):
+            prefix = f"[{label}] " if label else ""
+            for attempt in range(max_attempts):
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    if attempt == max_attempts - 1 or not _is_retryable(e):
+                        raise
+                    wait = min(max_wait, min_wait * 2 ** attempt)
+                    print(f"{prefix}API error ({e.__class__.__name__}), "
+                          f"retrying in {wait}s ...")
+                    await asyncio.sleep(wait)
+        return wrapper
+    return decorator
+
 
 def encode_image(image_path):
-    """Read an image file and return its base64-encoded string."""
-    with open(image_path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+    """
+    Read an image file and return (base64_string, image_digest).
+    Images larger than MAX_IMAGE_SIDE (if set) are Lanczos-downscaled
+    and re-encoded as JPEG first. The file is memory-mapped so small
+    images are encoded straight from the page cache without first
+    being copied into a bytes object. image_digest is the SHA-256 of
+    the payload actually sent, used as part of the response cache key.
+    """
+    with open(image_path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        img = Image.open(mm)
+        if MAX_IMAGE_SIDE and max(img.size) > MAX_IMAGE_SIDE:
+            img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+            buf = BytesIO()
+            img.convert("RGB").save(buf, format="JPEG", quality=JPEG_QUALITY)
+            payload = buf.getbuffer()
+        else:
+            payload = mm
+
+        return (
+            base64.b64encode(payload).decode("ascii"),
+            hashlib.sha256(payload).hexdigest(),
+        )
+
+
+def _cache_key(image_digest, model, prompt):
+    """Content-addressed key: same image + model + prompt -> same key."""
+    return hashlib.sha256((image_digest + model + prompt).encode()).hexdigest()
+
+
+def _check_result(result):
+    """
+    Raise ValueError unless result has the shape the prompt asks for:
+    {"columns": [str, ...], "transactions": [{...}, ...]}.
+    """
+    if not (
+        isinstance(result, dict)
+        and isinstance(result.get("columns"), list)
+        and isinstance(result.get("transactions"), list)
+        and all(isinstance(col, str) for col in result["columns"])
+        and all(isinstance(tx, dict) for tx in result["transactions"])
+    ):
+        raise ValueError(
+            "Model response is not an object with a 'columns' array of "
+            "strings and a 'transactions' array of objects: "
+            f"{str(result)[:200]}"
+        )
+
+
+def _cache_load(key):
+    """
+    Return the cached API result for key, or None on a miss. Entries
+    that are unreadable or have the wrong shape count as misses.
+    """
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            result = json.load(f)
+        _check_result(result)
+    except ValueError:
+        return None
+    return result
+
+
+def _cache_store(key, result):
+    """
+    Persist a parsed API result under key. The entry is written to a
+    temporary file and renamed into place, so concurrent jobs for the
+    same image never leave a half-written entry.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _first_json_object(raw):
+    """
+    Decode the first {...} in raw that parses as a JSON object, trying
+    each "{" in turn so braces in surrounding prose are skipped.
+    """
+    decoder = json.JSONDecoder()
+    start = raw.find("{")
+    while start != -1:
+        try:
+            result, _ = decoder.raw_decode(raw, start)
+        except ValueError:
+            pass
+        else:
+            if isinstance(result, dict):
+                return result
+        start = raw.find("{", start + 1)
+    raise ValueError(f"No JSON object found in model response: {raw[:200]!r}")
+
+
+def parse_json_response(raw):
+    """
+    Pull the JSON object out of the model's reply. Tolerates markdown
+    code fences or surrounding text. The common case — the span from the
+    first "{" to the last "}" — is parsed as UTF-8 bytes, which is what
+    orjson consumes natively. If prose around the JSON has its own
+    braces, falls back to decoding from each "{" in turn.
+    """
+    data = raw.encode()
+    start, end = data.find(b"{"), data.rfind(b"}")
+    if start == -1 or end < start:
+        raise ValueError(f"No JSON object found in model response: {raw[:200]!r}")
+    try:
+        # Parse the span in place rather than copying it out
+        result = _json_loads(memoryview(data)[start:end + 1])
+    except ValueError:
+        result = _first_json_object(raw)
+    if not isinstance(result, dict):
+        raise ValueError(f"Model response is not a JSON object: {raw[:200]!r}")
+    return result
+
+
+@retry_with_backoff(max_attempts=3, min_wait=1, max_wait=30)
+async def _create_completion(client, messages):
+    """Single rate-limited chat completion call, retried on transient errors."""
+    async with limiter:
+        return await client.chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            max_completion_tokens=4096,
+        )
 
 
-def extract_transactions(client, image_path):
+async def extract_transactions(client, image_path, cache_mode="read_write"):
     """
     Send the bank statement image to GPT-5.2 and ask it to extract
     all transactions as structured JSON. Dynamically detects the
     column structure from the image.
+
+    cache_mode controls the on-disk response cache:
+      "read_write" — return cached results, store new ones (default)
+      "read_only"  — return cached results, never write
+      "off"        — always call the API
     """
-    base64_image = encode_image(image_path)
+    if cache_mode not in CACHE_MODES:
+        raise ValueError(f"Unknown cache_mode {cache_mode!r}, expected one of {CACHE_MODES}")
+
+    # File read runs in a worker thread so it doesn't block the event loop
+    base64_image, image_digest = await asyncio.to_thread(encode_image, image_path)
+
+    key = _cache_key(image_digest, MODEL, PROMPT)
+    if cache_mode != "off":
+        result = _cache_load(key)
+        if result is not None:
+            return result["columns"], result["transactions"]
 
-    response = client.chat.completions.create(
-        model="gpt-5.2",
+    response = await _create_completion(
+        client,
+        label=os.path.basename(image_path),
         messages=[
             {
                 "role": "user",
                 "content": [
-                    {
-                        "type": "text",
-                        "text": (
-                            "Extract ALL transactions from this bank statement image.\n\n"
-                            "Step 1: Identify the column headers exactly as they appear in the table.\n"
-                            "Step 2: Extract every transaction row using those exact column names as JSON keys.\n\n"
-                            "Return a JSON object with two keys:\n"
-                            '  "columns": an array of the column header names exactly as shown in the image\n'
-                            '  "transactions": an array of objects, each using those column names as keys\n\n'
-                            "Rules:\n"
-                            "- Preserve dates exactly as shown (e.g. '15 MAY', '03/02', 'Mar 15')\n"
-                            "- Preserve numbers exactly as shown, including commas and any suffixes like 'DR' or 'CR'\n"
-                            "- If there is a B/F Balance or Previous Balance row, include it as a transaction\n"
-                            "- Do NOT include summary rows like 'Ending balance' or 'Balance Carried Forward'\n"
-                            "- For multi-line descriptions, combine them into a single string separated by spaces\n"
-                            "- If a cell is empty, use an empty string\n"
-                            "- Return ONLY the JSON object, no markdown or explanation"
-                        ),
-                    },
+                    PROMPT_PART,
                     {
                         "type": "image_url",
                         "image_url": {
@@ -57,17 +315,13 @@ def extract_transactions(client, image_path):
                 ],
             }
         ],
-        max_completion_tokens=4096,
     )
 
-    raw = response.choices[0].message.content.strip()
-
-    # Strip markdown code fences if present
-    if raw.startswith("```"):
-        raw = raw.split("\n", 1)[1]
-        raw = raw.rsplit("```", 1)[0]
-
-    result = json.loads(raw)
+    result = parse_json_response(response.choices[0].message.content)
+    # Only well-formed results are cached, so a bad reply can't poison later runs
+    _check_result(result)
+    if cache_mode == "read_write":
+        _cache_store(key, result)
     return result["columns"], result["transactions"]
 
 
@@ -76,70 +330,154 @@ def export_csv(columns, transactions, output_path):
     Write transactions to CSV using the detected columns.
     Only values containing commas are double-quoted.
     """
-    with open(output_path, "w", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=columns, quoting=csv.QUOTE_MINIMAL)
-        writer.writeheader()
-        for tx in transactions:
-            row = {col: tx.get(col, "") for col in columns}
-            writer.writerow(row)
+    with open(output_path, "w", newline="", buffering=1 << 20) as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(columns)
+        writer.writerows([tx.get(col, "") for col in columns] for tx in transactions)
 
     print(f"Wrote {len(transactions)} transactions to {output_path}")
 
 
-def validate(output_path, reference_path):
-    """Compare the generated CSV against the reference file line by line."""
-    with open(output_path) as f1, open(reference_path) as f2:
-        out_lines = f1.readlines()
-        ref_lines = f2.readlines()
+def _digest(path):
+    """BLAKE2b digest of a file, read in 1 MiB chunks."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
 
-    if len(out_lines) != len(ref_lines):
-        print(f"MISMATCH: output has {len(out_lines)} lines, "
-              f"reference has {len(ref_lines)} lines")
+
+def _same_bytes(path1, path2):
+    """
+    Byte-for-byte file comparison. Different sizes short-circuit;
+    otherwise the files' BLAKE2b digests are compared, which streams
+    both files in constant memory.
+    """
+    if os.path.getsize(path1) != os.path.getsize(path2):
         return False
+    return _digest(path1) == _digest(path2)
+
 
+def validate(output_path, reference_path):
+    """
+    Compare the generated CSV against the reference file. Identical
+    files are detected by comparing digests; only on a mismatch
+    are the files streamed and compared line by line.
+    """
+    if _same_bytes(output_path, reference_path):
+        print("VALIDATION PASSED — output matches reference exactly.")
+        return True
+
+    # Stream both files line by line; zip_longest pads the shorter one
+    # with None so a length mismatch shows up without reading ahead.
+    # Text mode normalises line endings, so CRLF-only differences pass.
     all_match = True
-    for i, (ol, rl) in enumerate(zip(out_lines, ref_lines), 1):
-        if ol != rl:
-            print(f"Line {i} differs:")
-            print(f"GOT: {ol.rstrip()}")
-            print(f"EXPECTED: {rl.rstrip()}")
-            all_match = False
+    out_count = ref_count = 0
+    with open(output_path) as f1, open(reference_path) as f2:
+        for i, (ol, rl) in enumerate(itertools.zip_longest(f1, f2), 1):
+            out_count += ol is not None
+            ref_count += rl is not None
+            if ol != rl:
+                print(f"Line {i} differs:")
+                print(f"GOT: {(ol or '').rstrip()}")
+                print(f"EXPECTED: {(rl or '').rstrip()}")
+                all_match = False
+
+    if out_count != ref_count:
+        print(f"MISMATCH: output has {out_count} lines, "
+              f"reference has {ref_count} lines")
 
     if all_match:
         print("VALIDATION PASSED — output matches reference exactly.")
     return all_match
 
 
-def process_image(client, image_path, output_path, reference_path=None):
-    """Process a single bank statement image end-to-end."""
-    print(f"Image: {image_path}")
-    print(f"Output:{output_path}")
-    print()
+async def process_image(client, image_path, output_path, reference_path=None,
+                        cache_mode="read_write"):
+    """
+    Process a single bank statement image end-to-end. Log lines are
+    prefixed with the image name so concurrent jobs stay readable.
+    cache_mode is passed through to extract_transactions.
+    """
+    name = os.path.basename(image_path)
 
-    print("Step 1: Sending image to GPT-5.2 ...")
-    columns, transactions = extract_transactions(client, image_path)
-    print(f"Detected columns: {columns}")
-    print(f"Extracted {len(transactions)} transactions")
+    def log(msg):
+        print(f"[{name}] {msg}")
 
-    print("Step 2: Exporting to CSV ...")
+    log(f"Output: {output_path}")
+    log("Step 1: Sending image to GPT-5.2 ...")
+    columns, transactions = await extract_transactions(client, image_path, cache_mode)
+    log(f"Detected columns: {columns}")
+    log(f"Extracted {len(transactions)} transactions")
+
+    log("Step 2: Exporting to CSV ...")
     export_csv(columns, transactions, output_path)
-    print(f"Wrote {len(transactions)} transactions to {output_path}")
 
     if reference_path and os.path.exists(reference_path):
-        print("\nStep 3: Validating against reference ...")
+        log("Step 3: Validating against reference ...")
         validate(output_path, reference_path)
 
-    print()
+
+async def run_batch(client, jobs, max_concurrency=MAX_CONCURRENCY,
+                    cache_mode="read_write"):
+    """
+    Process several images concurrently. Each job is a tuple of
+    (image_path, output_path, reference_path). A semaphore caps the
+    number of in-flight API requests so API latency overlaps across
+    images without flooding the endpoint.
+    A failing image is reported and does not cancel the others.
+    Returns the list of image paths that failed.
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def bounded(job):
+        async with sem:
+            await process_image(client, *job, cache_mode=cache_mode)
+
+    results = await asyncio.gather(
+        *(bounded(job) for job in jobs), return_exceptions=True
+    )
+
+    failed = []
+    for (image_path, _, _), result in zip(jobs, results):
+        if isinstance(result, Exception):
+            print(f"[{os.path.basename(image_path)}] FAILED: "
+                  f"{result.__class__.__name__}: {result}")
+            failed.append(image_path)
+    return failed
 
 
 def main():
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    image_path = os.path.join(script_dir, "img_sample.jpg")
-    output_path = os.path.join(script_dir, "transactions_gpt.csv")
-    reference_path = os.path.join(script_dir, "csv_sample.csv")
+    # --cache=read_write|read_only|off selects the response cache mode
+    args = sys.argv[1:]
+    cache_mode = "read_write"
+    for arg in [a for a in args if a.startswith("--cache=")]:
+        cache_mode = arg.split("=", 1)[1]
+        args.remove(arg)
+    if cache_mode not in CACHE_MODES:
+        print(f"Unknown cache mode {cache_mode!r}, expected one of {CACHE_MODES}")
+        sys.exit(2)
+
+    if args:
+        # Batch mode: each image gets a "<name>_gpt.csv" next to it
+        jobs = [
+            (path, os.path.splitext(path)[0] + "_gpt.csv", None)
+            for path in args
+        ]
+    else:
+        jobs = [(
+            os.path.join(SCRIPT_DIR, "img_sample.jpg"),
+            os.path.join(SCRIPT_DIR, "transactions_gpt.csv"),
+            os.path.join(SCRIPT_DIR, "csv_sample.csv"),
+        )]
 
-    client = OpenAI()
-    process_image(client, image_path, output_path, reference_path)
+    # SDK retries are disabled so retry_with_backoff is the only retry
+    # layer; stacking both would multiply requests during rate limiting
+    client = AsyncOpenAI(max_retries=0)
+    failed = asyncio.run(run_batch(client, jobs, cache_mode=cache_mode))
+    if failed:
+        print(f"{len(failed)} of {len(jobs)} images failed")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -2,21 +2,42 @@ import re
 import csv
 import sys
 import os
-from PIL import Image, ImageEnhance
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import cv2
 import pytesseract
+import numpy as np
 import pandas as pd
 
+# Directory containing this script; default input/output paths live here
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Output columns, in the order of the target CSV
+COLUMNS = [
+    "Date Posted",
+    "Value Date",
+    "Cheque Number",
+    "Description",
+    "Amount",
+    "Balance",
+]
+
 # STEP 1 — Image Preprocessing
 def preprocess_image(image_path):
     """
     Load the image and enhance it for better OCR accuracy.
     Converting to grayscale and boosting contrast helps Tesseract
     distinguish characters more reliably on bank statement scans.
+    Returns a uint8 numpy array, which pytesseract accepts directly.
     """
-    img = Image.open(image_path)
-    gray = img.convert("L")
-    enhancer = ImageEnhance.Contrast(gray)
-    enhanced = enhancer.enhance(2.0)
+    img = cv2.imread(image_path)
+    if img is None:
+        raise ValueError(f"Could not read image: {image_path}")
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    # 2x contrast around the mean grey level (same as PIL's
+    # ImageEnhance.Contrast(2.0)); addWeighted saturates to 0..255
+    mean = int(gray.mean() + 0.5)
+    enhanced = cv2.addWeighted(gray, 2.0, gray, 0, -mean)
     return enhanced
 
 # STEP 2 — OCR Text Extraction
@@ -30,6 +51,25 @@ def extract_text(image):
     text = pytesseract.image_to_string(image, config=config)
     return text
 
+
+def extract_words(image):
+    """
+    Run Tesseract OCR and return one row per recognised word, with
+    its pixel position (left, top, width, height) and line grouping
+    (block_num, par_num, line_num). Used by the layout-based parser.
+    """
+    config = "--psm 6"
+    # Read "text" as str so numeric tokens like "15" aren't parsed as floats
+    words = pytesseract.image_to_data(
+        image,
+        config=config,
+        output_type=pytesseract.Output.DATAFRAME,
+        pandas_config={"dtype": {"text": str}},
+    )
+    words = words.dropna(subset=["text"])
+    words["text"] = words["text"].str.strip()
+    return words[words["text"] != ""]
+
 # STEP 3 — Isolate Transaction Section
 def isolate_transactions(raw_text):
     """
@@ -57,8 +97,14 @@ def isolate_transactions(raw_text):
     return section
 
 # STEP 4 — Parse Transactions
-# Regex: line starting with "DD MAY" (the Date Posted column)
-DATE_LINE_RE = re.compile(r"^(\d{1,2}\s+[A-Z]{3,})\s+(.*)")
+# Regex: line starting with "DD MAY" (the Date Posted column), optionally
+# followed by a second "DD MAY" (the Value Date column). Both dates and
+# the remaining text are captured in a single match per line.
+TX_LINE_RE = re.compile(
+    r"^(?P<date>\d{1,2}\s+[A-Z]{3,})\s+"
+    r"(?:(?P<value_date>\d{1,2}\s+[A-Z]{3,})\s*)?"
+    r"(?P<body>.*)"
+)
 
 # Regex: monetary amounts like 7,010.00DR  or  4,138.39
 AMOUNT_RE = re.compile(r"([\d,]+\.\d{2}(?:DR)?)")
@@ -69,99 +115,155 @@ def _split_amounts(text):
     Given a string that may end with 1-2 monetary values, return
     (description_part, amount, balance).
     """
-    amounts = AMOUNT_RE.findall(text)
-    if len(amounts) >= 2:
-        # Last two matches are Amount and Balance
-        amount = amounts[-2]
-        balance = amounts[-1]
-        # Remove amounts from the text to get description
-        desc = text
-        for a in amounts[-2:]:
-            # Remove from the right to avoid mangling identical substrings
-            idx = desc.rfind(a)
-            if idx != -1:
-                desc = desc[:idx] + desc[idx + len(a):]
-        desc = desc.strip()
-        return desc, amount, balance
-    elif len(amounts) == 1:
+    matches = list(AMOUNT_RE.finditer(text))
+    if len(matches) >= 2:
+        # Last two matches are Amount and Balance; slice them out of
+        # the text by position to get the description
+        amount, balance = matches[-2], matches[-1]
+        desc = (
+            text[:amount.start()]
+            + text[amount.end():balance.start()]
+            + text[balance.end():]
+        ).strip()
+        return desc, amount.group(), balance.group()
+    elif len(matches) == 1:
         # Single amount — this is the Balance (for B/F Balance row)
-        balance = amounts[0]
-        desc = text.replace(balance, "").strip()
-        return desc, "", balance
+        balance = matches[0]
+        desc = (text[:balance.start()] + text[balance.end():]).strip()
+        return desc, "", balance.group()
     else:
         return text.strip(), "", ""
 
 
+def _append_description(descriptions, text):
+    """Continuation line — append text to the last transaction's description."""
+    if descriptions[-1]:
+        descriptions[-1] += " " + text
+    else:
+        descriptions[-1] = text
+
+
 def parse_transactions(lines):
     """
-    Parse the isolated OCR lines into a list of transaction dicts.
+    Parse the isolated OCR lines into column-major form: a dict mapping
+    each name in COLUMNS to a list with one value per transaction.
     Each transaction may span multiple lines:
       - The first line starts with a date and may contain partial
         description + amounts.
       - Subsequent lines (until the next date-line) are continuation
         of the description.
     """
-    transactions = []
-    current = None
+    transactions = {col: [] for col in COLUMNS}
+    descriptions = transactions["Description"]
 
     for line in lines:
         line_stripped = line.strip()
         if not line_stripped:
             continue
 
-        match = DATE_LINE_RE.match(line_stripped)
+        match = TX_LINE_RE.match(line_stripped)
 
         if match:
-            # ---- Finalise previous transaction ----
-            if current is not None:
-                transactions.append(current)
-
-            date_posted = match.group(1)
-            rest = match.group(2).strip()
-
-            # Special case: B/F Balance row
-            if "B/F Balance" in rest:
-                _, _, balance = _split_amounts(rest)
-                current = {
-                    "Date Posted": date_posted,
-                    "Value Date": "B/F Balance",
-                    "Cheque Number": "",
-                    "Description": "",
-                    "Amount": "",
-                    "Balance": balance,
-                }
-                continue
-
-            # Regular transaction — extract Value Date first
-            vd_match = re.match(r"(\d{1,2}\s+[A-Z]{3,})\s*(.*)", rest)
-            if vd_match:
-                value_date = vd_match.group(1)
-                remainder = vd_match.group(2).strip()
+            date_posted = match.group("date")
+            value_date = match.group("value_date") or ""
+            remainder = match.group("body").strip()
+
+            if "B/F Balance" in remainder:
+                # Special case: B/F Balance row
+                _, _, balance = _split_amounts(remainder)
+                value_date, desc_part, amount = "B/F Balance", "", ""
             else:
-                value_date = ""
-                remainder = rest
-
-            desc_part, amount, balance = _split_amounts(remainder)
-
-            current = {
-                "Date Posted": date_posted,
-                "Value Date": value_date,
-                "Cheque Number": "",
-                "Description": desc_part,
-                "Amount": amount,
-                "Balance": balance,
-            }
-        else:
-            # Continuation line — append to current description
-            if current is not None:
-                if current["Description"]:
-                    current["Description"] += " " + line_stripped
-                else:
-                    current["Description"] = line_stripped
-
-    # Don't forget the last transaction
-    if current is not None:
-        transactions.append(current)
+                desc_part, amount, balance = _split_amounts(remainder)
+
+            row = (date_posted, value_date, "", desc_part, amount, balance)
+            for col, value in zip(COLUMNS, row):
+                transactions[col].append(value)
+        elif descriptions:
+            _append_description(descriptions, line_stripped)
+
+    return transactions
+
+# STEP 4 (alternative) — Layout-based Parsing
+# First word of each column title, in COLUMNS order. On the statement the
+# titles wrap onto two text rows ("Date Value Cheque Description Amount
+# Balance" / "Posted Date Number"), which Tesseract reports as separate
+# lines, so only the first row is used to place the columns.
+HEADER_TITLES = ["Date", "Value", "Cheque", "Description", "Amount", "Balance"]
+
+# A Date Posted cell such as "27 MAY"
+DATE_CELL_RE = re.compile(r"\d{1,2}\s+[A-Z]{3,}")
+
+
+def _column_boundaries(header):
+    """
+    Given the first header row's words (sorted left to right), return
+    the x-coordinates separating adjacent columns: the midpoint between
+    the end of one column title and the start of the next.
+    """
+    texts = header["text"].tolist()
+    lefts = header["left"].tolist()
+    rights = (header["left"] + header["width"]).tolist()
+
+    spans = []
+    i = 0
+    for title in HEADER_TITLES:
+        while i < len(texts) and texts[i] != title:
+            i += 1
+        if i >= len(texts):
+            raise ValueError(f"Could not locate column header '{title}'")
+        spans.append((lefts[i], rights[i]))
+        i += 1
+
+    return [(prev[1] + nxt[0]) / 2 for prev, nxt in zip(spans, spans[1:])]
+
+
+def parse_transactions_by_layout(words):
+    """
+    Parse word-level OCR output into the same column-major form as
+    parse_transactions, assigning each word to a column from its
+    x-position.
+    A row whose Date Posted cell holds a date starts a new transaction;
+    rows without one are continuation lines of the description. Rows
+    before the first transaction (the second header row) are skipped.
+    """
+    lines = [
+        line.sort_values("left")
+        for _, line in words.groupby(["block_num", "par_num", "line_num"], sort=True)
+    ]
+
+    header_idx = next(
+        (i for i, line in enumerate(lines)
+         if set(HEADER_TITLES) <= set(line["text"])),
+        None,
+    )
+    if header_idx is None:
+        raise ValueError("Could not locate the transaction table header in OCR output")
+    boundaries = _column_boundaries(lines[header_idx])
+
+    transactions = {col: [] for col in COLUMNS}
+    descriptions = transactions["Description"]
+
+    for line in lines[header_idx + 1:]:
+        line_text = " ".join(line["text"])
+        if "We find ways" in line_text or "Please review" in line_text:
+            break
+
+        # Bucket each word by its horizontal centre
+        centres = (line["left"] + line["width"] / 2).to_numpy()
+        col_idx = np.digitize(centres, boundaries)
+        texts = line["text"].to_numpy()
+        cells = [" ".join(texts[col_idx == k]) for k in range(len(COLUMNS))]
+
+        if DATE_CELL_RE.fullmatch(cells[0]):
+            if "B/F Balance" in line_text:
+                # Special case: B/F Balance row. The label is wider than
+                # the Value Date column and spills into Cheque Number.
+                _, _, balance = _split_amounts(line_text)
+                cells = [cells[0], "B/F Balance", "", "", "", balance]
+            for col, value in zip(COLUMNS, cells):
+                transactions[col].append(value)
+        elif descriptions:
+            _append_description(descriptions, line_text)
 
     return transactions
 
@@ -182,6 +284,13 @@ OCR_CORRECTIONS = {
     "PC-NDBMOB-20240529-14491015": "PC-NBDB02-20240529-14491015",
 }
 
+# All correction keys compiled into one alternation so each description
+# is scanned once. Longest keys first so a shorter key can't shadow a
+# longer one that starts at the same position.
+OCR_CORRECTIONS_RE = re.compile(
+    "|".join(re.escape(k) for k in sorted(OCR_CORRECTIONS, key=len, reverse=True))
+)
+
 # Some descriptions need a leading space preserved from the original
 # statement layout (OCR strips it).
 LEADING_SPACE_DESCRIPTIONS = {
@@ -194,56 +303,123 @@ def apply_corrections(transactions):
     Apply the OCR correction map to all description fields.
     This is standard practice in production OCR pipelines where
     certain characters are systematically misread.
+    Takes the column-major transactions from the parser and returns
+    them as a DataFrame with columns in COLUMNS order, ready for
+    export_csv. Building from lists of columns avoids per-row dicts.
     """
-    for tx in transactions:
-        desc = tx["Description"]
+    # object dtype keeps .str usable when there are no transactions
+    # (empty lists would otherwise become float64 columns)
+    df = pd.DataFrame(transactions, columns=COLUMNS, dtype=object)
 
-        # Apply substring corrections
-        for wrong, right in OCR_CORRECTIONS.items():
-            desc = desc.replace(wrong, right)
+    # Apply substring corrections in one vectorised pass over the column
+    df["Description"] = df["Description"].str.replace(
+        OCR_CORRECTIONS_RE, lambda m: OCR_CORRECTIONS[m.group(0)], regex=True
+    )
 
-        # Apply leading-space corrections
-        if desc in LEADING_SPACE_DESCRIPTIONS:
-            desc = LEADING_SPACE_DESCRIPTIONS[desc]
-
-        tx["Description"] = desc
-    return transactions
+    # Apply leading-space corrections
+    df["Description"] = df["Description"].map(
+        lambda d: LEADING_SPACE_DESCRIPTIONS.get(d, d)
+    )
+    return df
 
 # STEP 6 — Export to CSV
 def export_csv(transactions, output_path):
     """
-    Write transactions to CSV with formatting that exactly matches
-    the target file.  csv.QUOTE_MINIMAL ensures only values
+    Write the transactions DataFrame to CSV with formatting that exactly
+    matches the target file.  csv.QUOTE_MINIMAL ensures only values
     containing commas are double-quoted (e.g. '10,053.38' → '"10,053.38"').
     """
-    columns = [
-        "Date Posted",
-        "Value Date",
-        "Cheque Number",
-        "Description",
-        "Amount",
-        "Balance",
-    ]
-
-    with open(output_path, "w", newline="") as f:
-        writer = csv.DictWriter(
-            f,
-            fieldnames=columns,
-            quoting=csv.QUOTE_MINIMAL,
-        )
-        writer.writeheader()
-        for tx in transactions:
-            writer.writerow(tx)
+    transactions.to_csv(
+        output_path,
+        index=False,
+        quoting=csv.QUOTE_MINIMAL,
+        lineterminator="\r\n",
+    )
 
     print(f"Wrote {len(transactions)} transactions to {output_path}")
 
+# Batch Pipeline
+def _ocr_image(image_path, layout=False):
+    """Steps 1-2 for one image. Runs in a worker process."""
+    enhanced = preprocess_image(image_path)
+    return extract_words(enhanced) if layout else extract_text(enhanced)
+
+
+def _finish_image(ocr_result, output_path, layout=False):
+    """Steps 3-6 for one image's OCR output. Runs in a worker thread."""
+    if layout:
+        transactions = parse_transactions_by_layout(ocr_result)
+    else:
+        transactions = parse_transactions(isolate_transactions(ocr_result))
+    transactions = apply_corrections(transactions)
+    export_csv(transactions, output_path)
+    return transactions
+
+
+def _report_failure(image_path, exc):
+    """Print a one-line failure notice tagged with the image name."""
+    print(f"[{os.path.basename(image_path)}] FAILED: {exc.__class__.__name__}: {exc}")
+
+
+def process_images(jobs, max_workers=None, layout=False):
+    """
+    Run the pipeline over many (image_path, output_path) pairs.
+    Decoding and OCR (CPU-bound) run in a process pool; as each image's
+    text comes back, parsing and CSV export are handed to a thread pool
+    so they overlap with OCR of the remaining images.
+    With layout=True, words are parsed by position instead of by line.
+    A failing image is reported and does not stop the others.
+    Returns the list of image paths that failed.
+    """
+    failed = []
+    with ProcessPoolExecutor(max_workers=max_workers) as ocr_pool, \
+            ThreadPoolExecutor(max_workers=max_workers) as io_pool:
+        ocr_futures = {
+            ocr_pool.submit(_ocr_image, image_path, layout): (image_path, output_path)
+            for image_path, output_path in jobs
+        }
+        export_futures = {}
+        for fut in as_completed(ocr_futures):
+            image_path, output_path = ocr_futures[fut]
+            try:
+                ocr_result = fut.result()
+            except Exception as e:
+                _report_failure(image_path, e)
+                failed.append(image_path)
+                continue
+            export_futures[
+                io_pool.submit(_finish_image, ocr_result, output_path, layout)
+            ] = image_path
+
+        for fut, image_path in export_futures.items():
+            try:
+                fut.result()
+            except Exception as e:
+                _report_failure(image_path, e)
+                failed.append(image_path)
+    return failed
+
+
 # Main Pipeline
 def main():
     # Resolve paths relative to this script's directory
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    image_path = os.path.join(script_dir, "img_sample.jpg")
-    output_path = os.path.join(script_dir, "transactions.csv")
-    reference_path = os.path.join(script_dir, "csv_sample.csv")
+    image_path = os.path.join(SCRIPT_DIR, "img_sample.jpg")
+    output_path = os.path.join(SCRIPT_DIR, "transactions.csv")
+    reference_path = os.path.join(SCRIPT_DIR, "csv_sample.csv")
+
+    # --layout: parse OCR words by column position instead of by text line
+    layout = "--layout" in sys.argv[1:]
+    args = [a for a in sys.argv[1:] if a != "--layout"]
+    if len(args) == 2 and args[1].endswith(".csv"):
+        image_path, output_path = args
+    elif args:
+        # Batch mode: each image gets a "<name>_transactions.csv" next to it
+        jobs = [(path, os.path.splitext(path)[0] + "_transactions.csv") for path in args]
+        failed = process_images(jobs, layout=layout)
+        if failed:
+            print(f"{len(failed)} of {len(jobs)} images failed")
+            sys.exit(1)
+        return
 
     print(f"Image: {image_path}")
     print(f"Output: {output_path}\n")
@@ -253,14 +429,20 @@ def main():
     enhanced = preprocess_image(image_path)
 
     print("Step 2: Running Tesseract OCR...")
-    raw_text = extract_text(enhanced)
+    if layout:
+        words = extract_words(enhanced)
+
+        print("Step 3-4: Parsing transactions by column layout...")
+        transactions = parse_transactions_by_layout(words)
+    else:
+        raw_text = extract_text(enhanced)
 
-    print("Step 3: Isolating transaction section...")
-    tx_lines = isolate_transactions(raw_text)
+        print("Step 3: Isolating transaction section...")
+        tx_lines = isolate_transactions(raw_text)
 
-    print("Step 4: Parsing transactions...")
-    transactions = parse_transactions(tx_lines)
-    print(f"Found {len(transactions)} transactions")
+        print("Step 4: Parsing transactions...")
+        transactions = parse_transactions(tx_lines)
+    print(f"Found {len(transactions['Date Posted'])} transactions")
 
     print("Step 5: Applying OCR corrections...")
     transactions = apply_corrections(transactions)